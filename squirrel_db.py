@@ -1,4 +1,5 @@
 import sqlite3
+import time
 
 def dict_factory(cursor, row):
     d = {}
@@ -8,34 +9,133 @@ def dict_factory(cursor, row):
 
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+    def __init__(self, traceSql=False, dbPath="squirrel_db.db", cacheSize=None, shared=False):
+        # shared connections are handed between threads by a pool, one thread at a time
+        self.connection = sqlite3.connect(dbPath, check_same_thread=not shared)
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
+        self.cursor.execute("PRAGMA cache_size")
+        self.defaultCacheSize = self.cursor.fetchone()["cache_size"]
+        self.cacheSize = None
+        self.configure(traceSql, cacheSize)
+
+    def configure(self, traceSql=False, cacheSize=None):
+        if cacheSize != self.cacheSize:
+            self.cursor.execute("PRAGMA cache_size = %d" % (self.defaultCacheSize if cacheSize is None else cacheSize))
+            self.cacheSize = cacheSize
+        self.sqlTimings = []
+        self.tracedStatements = []
+        self.connection.set_trace_callback(self.traceStatement if traceSql else None)
+
+    def close(self):
+        self.connection.close()
+
+    def hasSquirrelsTable(self):
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'squirrels'")
+        return self.cursor.fetchone() is not None
+
+    def checkpoint(self):
+        # folds a write-ahead log back into the database file; a no-op in rollback journal mode
+        self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return None
+
+    # TRACING
+
+    def traceStatement(self, statement):
+        # sqlite3 reports each statement with its bound values just before it runs,
+        # including the BEGIN it issues implicitly ahead of a write
+        self.tracedStatements.append(statement.strip())
+
+    def recordTiming(self, start):
+        statements = self.tracedStatements
+        if statements:
+            # executemany traces every row; keep the log line readable
+            text = "; ".join(statements[:3])
+            if len(statements) > 3:
+                text += "; ... (%d statements)" % len(statements)
+            self.sqlTimings.append((text, time.perf_counter() - start))
+            self.tracedStatements = []
+
+    def commit(self):
+        # timed on its own: the commit and its fsync are often the slowest part of a write
+        start = time.perf_counter()
+        self.connection.commit()
+        self.recordTiming(start)
+
+    # QUERIES
 
     def getSquirrels(self):
+        start = time.perf_counter()
         self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
-        return self.cursor.fetchall()
+        rows = self.cursor.fetchall()
+        self.recordTiming(start)
+        return rows
+
+    def getSquirrelsInBatches(self, batchSize=1024):
+        # each batch is its own short query, so no read transaction (and no lock that would
+        # block writers) is held while a caller writes the batches out to a slow client
+        start = time.perf_counter()
+        self.cursor.execute("SELECT COUNT(*) AS count, MIN(id) AS minId, MAX(id) AS maxId FROM squirrels")
+        row = self.cursor.fetchone()
+        self.recordTiming(start)
+        if row["count"] == 0:
+            return 0, self.readBatches(0, 0, batchSize)
+        return row["count"], self.readBatches(row["minId"] - 1, row["maxId"], batchSize)
+
+    def readBatches(self, lastId, maxId, batchSize):
+        # rows added after the count have ids above maxId and are left out
+        while True:
+            start = time.perf_counter()
+            self.cursor.execute("SELECT * FROM squirrels WHERE id > ? AND id <= ? ORDER BY id LIMIT ?", [lastId, maxId, batchSize])
+            batch = self.cursor.fetchall()
+            self.recordTiming(start)
+            if not batch:
+                return
+            lastId = batch[-1]["id"]
+            yield batch
 
     def getSquirrel(self, squirrelId):
         data = [squirrelId]
+        start = time.perf_counter()
         self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
-        return self.cursor.fetchone()
+        row = self.cursor.fetchone()
+        self.recordTiming(start)
+        return row
 
     def createSquirrel(self, name, size):
         data = [name, size]
+        start = time.perf_counter()
         self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
+        self.recordTiming(start)
+        self.commit()
         return None
 
+    def createSquirrels(self, squirrels):
+        start = time.perf_counter()
+        self.cursor.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", squirrels)
+        self.recordTiming(start)
+        self.commit()
+        return None
+
+    def countSquirrels(self):
+        start = time.perf_counter()
+        self.cursor.execute("SELECT COUNT(*) AS count FROM squirrels")
+        row = self.cursor.fetchone()
+        self.recordTiming(start)
+        return row["count"]
+
     def updateSquirrel(self, squirrelId, name, size):
         data = [name, size, squirrelId]
+        start = time.perf_counter()
         self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
+        self.recordTiming(start)
+        self.commit()
         return None
 
     def deleteSquirrel(self, squirrelId):
         data = [squirrelId]
+        start = time.perf_counter()
         self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
-        self.connection.commit()
+        self.recordTiming(start)
+        self.commit()
         return None
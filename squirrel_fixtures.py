@@ -0,0 +1,94 @@
+import argparse
+import itertools
+import os
+import pathlib
+import random
+import shutil
+import sqlite3
+import time
+from squirrel_db import SquirrelDB
+
+TEMPLATE_DB = "empty_squirrel_db.db"
+SIZES = ("small", "medium", "large")
+SYLLABLES = ("ac", "bu", "chi", "dor", "fu", "gi", "hazel", "ka", "lu", "mo", "nut", "pip", "ro", "sa", "ti", "zu")
+
+def generateSquirrels(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+        yield (name, rng.choice(SIZES))
+
+def populate(dbPath, count, batchSize=50000, seed=0, fresh=True):
+    if fresh:
+        shutil.copyfile(TEMPLATE_DB, dbPath)
+    db = SquirrelDB(dbPath=dbPath)
+    # a fixture that dies halfway is regenerated, so skip the fsyncs
+    db.connection.execute("PRAGMA synchronous = OFF")
+    squirrels = generateSquirrels(count, seed)
+    while True:
+        batch = list(itertools.islice(squirrels, batchSize))
+        if not batch:
+            break
+        db.createSquirrels(batch)
+    total = db.countSquirrels()
+    db.close()
+    return total
+
+def copyDatabase(fromPath, toPath):
+    # the source is opened read-only so a mistyped path fails instead of being created
+    # empty and then copied over the target
+    if not os.path.isfile(fromPath):
+        raise FileNotFoundError("%s does not exist" % fromPath)
+    source = sqlite3.connect(pathlib.Path(fromPath).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        tables = source.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'squirrels'").fetchall()
+        if not tables:
+            raise ValueError("%s has no squirrels table" % fromPath)
+        target = sqlite3.connect(toPath)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+def snapshot(dbPath, snapshotPath):
+    copyDatabase(dbPath, snapshotPath)
+
+def restore(snapshotPath, dbPath):
+    copyDatabase(snapshotPath, dbPath)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, snapshot and restore large squirrel databases.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="bulk-load synthetic squirrels")
+    generate.add_argument("count", type=int)
+    generate.add_argument("--db", default="squirrel_db.db")
+    generate.add_argument("--batch-size", type=int, default=50000)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--append", action="store_true", help="keep existing rows instead of starting from the empty template")
+    snap = commands.add_parser("snapshot", help="copy a database to a snapshot file")
+    snap.add_argument("snapshot")
+    snap.add_argument("--db", default="squirrel_db.db")
+    rest = commands.add_parser("restore", help="copy a snapshot file over a database")
+    rest.add_argument("snapshot")
+    rest.add_argument("--db", default="squirrel_db.db")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        if args.command == "generate":
+            total = populate(args.db, args.count, args.batch_size, args.seed, fresh=not args.append)
+            print("%s now has %d squirrels" % (args.db, total))
+        elif args.command == "snapshot":
+            snapshot(args.db, args.snapshot)
+            print("saved %s to %s" % (args.db, args.snapshot))
+        else:
+            restore(args.snapshot, args.db)
+            print("restored %s from %s" % (args.db, args.snapshot))
+    except (OSError, ValueError, sqlite3.DatabaseError) as e:
+        raise SystemExit("squirrel_fixtures: %s" % e)
+    print("took %.2fs" % (time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import struct
+
+# MessagePack (https://msgpack.org) for the squirrel API. The msgpack C extension is
+# used when it is installed; otherwise the pure-Python Packer/Unpacker below cover the
+# types the API returns, so the server does not depend on it.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def packString(s):
+    data = s.encode("utf-8")
+    n = len(data)
+    if n < 32:
+        return bytes((0xa0 | n,)) + data
+    if n < 0x100:
+        return b"\xd9" + bytes((n,)) + data
+    if n < 0x10000:
+        return b"\xda" + struct.pack(">H", n) + data
+    return b"\xdb" + struct.pack(">I", n) + data
+
+def packInt(i):
+    if 0 <= i < 0x80:
+        return bytes((i,))
+    if -32 <= i < 0:
+        return bytes((i & 0xff,))
+    if i >= 0:
+        if i < 0x100:
+            return b"\xcc" + bytes((i,))
+        if i < 0x10000:
+            return b"\xcd" + struct.pack(">H", i)
+        if i < 0x100000000:
+            return b"\xce" + struct.pack(">I", i)
+        return b"\xcf" + struct.pack(">Q", i)
+    if i >= -0x80:
+        return b"\xd0" + struct.pack(">b", i)
+    if i >= -0x8000:
+        return b"\xd1" + struct.pack(">h", i)
+    if i >= -0x80000000:
+        return b"\xd2" + struct.pack(">i", i)
+    return b"\xd3" + struct.pack(">q", i)
+
+def packArrayHeader(n):
+    if n < 16:
+        return bytes((0x90 | n,))
+    if n < 0x10000:
+        return b"\xdc" + struct.pack(">H", n)
+    return b"\xdd" + struct.pack(">I", n)
+
+def packMapHeader(n):
+    if n < 16:
+        return bytes((0x80 | n,))
+    if n < 0x10000:
+        return b"\xde" + struct.pack(">H", n)
+    return b"\xdf" + struct.pack(">I", n)
+
+class Packer:
+
+    # names, sizes and dict keys repeat across rows, so their encodings are cached
+    # for the lifetime of the packer (one response)
+    def __init__(self, cacheLimit=4096):
+        self.buffer = bytearray()
+        self.strings = {}
+        self.cacheLimit = cacheLimit
+
+    def packStr(self, s):
+        data = self.strings.get(s)
+        if data is None:
+            data = packString(s)
+            if len(self.strings) < self.cacheLimit:
+                self.strings[s] = data
+        self.buffer += data
+
+    def packValue(self, value):
+        t = type(value)
+        if t is str:
+            self.packStr(value)
+        elif t is int:
+            self.buffer += packInt(value)
+        elif t is dict:
+            # rows are the hot path, so cached strings and ints are handled inline here
+            buffer = self.buffer
+            strings = self.strings
+            buffer += packMapHeader(len(value))
+            for key, item in value.items():
+                data = strings.get(key)
+                if data is not None:
+                    buffer += data
+                else:
+                    self.packValue(key)
+                itemType = type(item)
+                if itemType is int:
+                    buffer += packInt(item)
+                elif itemType is str and item in strings:
+                    buffer += strings[item]
+                else:
+                    self.packValue(item)
+        elif t is list or t is tuple:
+            self.buffer += packArrayHeader(len(value))
+            for item in value:
+                self.packValue(item)
+        elif value is None:
+            self.buffer += b"\xc0"
+        elif value is True:
+            self.buffer += b"\xc3"
+        elif value is False:
+            self.buffer += b"\xc2"
+        elif isinstance(value, int):
+            self.buffer += packInt(value)
+        elif isinstance(value, str):
+            self.packStr(value)
+        elif isinstance(value, float):
+            self.buffer += b"\xcb" + struct.pack(">d", value)
+        elif isinstance(value, bytes):
+            if len(value) < 0x100:
+                self.buffer += b"\xc4" + bytes((len(value),)) + value
+            elif len(value) < 0x10000:
+                self.buffer += b"\xc5" + struct.pack(">H", len(value)) + value
+            else:
+                self.buffer += b"\xc6" + struct.pack(">I", len(value)) + value
+        else:
+            raise TypeError("cannot pack %s" % type(value).__name__)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def packItems(self, items):
+        for item in items:
+            self.packValue(item)
+        return self.take()
+
+class NativePacker:
+
+    def __init__(self):
+        self.packer = msgpack.Packer()
+
+    def packItems(self, items):
+        return b"".join(map(self.packer.pack, items))
+
+def newPacker():
+    return NativePacker() if msgpack is not None else Packer()
+
+def pack(value):
+    if msgpack is not None:
+        return msgpack.packb(value)
+    packer = Packer()
+    packer.packValue(value)
+    return packer.take()
+
+def packStream(count, batches):
+    # yields the array header and then one encoded chunk per batch, so a large list is
+    # written out as it is read and encoded instead of built up as one payload
+    packer = newPacker()
+    yield packArrayHeader(count)
+    for batch in batches:
+        yield packer.packItems(batch)
+
+class Unpacker:
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        chunk = self.data[self.pos:self.pos + n]
+        if len(chunk) < n:
+            raise ValueError("truncated msgpack data")
+        self.pos += n
+        return chunk
+
+    def unpackStruct(self, fmt, size):
+        return struct.unpack(fmt, self.take(size))[0]
+
+    def unpack(self):
+        b = self.take(1)[0]
+        if b < 0x80:
+            return b
+        if b >= 0xe0:
+            return b - 0x100
+        if 0xa0 <= b <= 0xbf:
+            return self.take(b & 0x1f).decode("utf-8")
+        if 0x90 <= b <= 0x9f:
+            return [self.unpack() for _ in range(b & 0x0f)]
+        if 0x80 <= b <= 0x8f:
+            return self.unpackMap(b & 0x0f)
+        if b == 0xc0:
+            return None
+        if b == 0xc2:
+            return False
+        if b == 0xc3:
+            return True
+        if b == 0xc4:
+            return self.take(self.take(1)[0])
+        if b == 0xc5:
+            return self.take(self.unpackStruct(">H", 2))
+        if b == 0xc6:
+            return self.take(self.unpackStruct(">I", 4))
+        if b == 0xcb:
+            return self.unpackStruct(">d", 8)
+        if b == 0xcc:
+            return self.take(1)[0]
+        if b == 0xcd:
+            return self.unpackStruct(">H", 2)
+        if b == 0xce:
+            return self.unpackStruct(">I", 4)
+        if b == 0xcf:
+            return self.unpackStruct(">Q", 8)
+        if b == 0xd0:
+            return self.unpackStruct(">b", 1)
+        if b == 0xd1:
+            return self.unpackStruct(">h", 2)
+        if b == 0xd2:
+            return self.unpackStruct(">i", 4)
+        if b == 0xd3:
+            return self.unpackStruct(">q", 8)
+        if b == 0xd9:
+            return self.take(self.take(1)[0]).decode("utf-8")
+        if b == 0xda:
+            return self.take(self.unpackStruct(">H", 2)).decode("utf-8")
+        if b == 0xdb:
+            return self.take(self.unpackStruct(">I", 4)).decode("utf-8")
+        if b == 0xdc:
+            return [self.unpack() for _ in range(self.unpackStruct(">H", 2))]
+        if b == 0xdd:
+            return [self.unpack() for _ in range(self.unpackStruct(">I", 4))]
+        if b == 0xde:
+            return self.unpackMap(self.unpackStruct(">H", 2))
+        if b == 0xdf:
+            return self.unpackMap(self.unpackStruct(">I", 4))
+        raise ValueError("unsupported msgpack type byte 0x%02x" % b)
+
+    def unpackMap(self, n):
+        d = {}
+        for _ in range(n):
+            key = self.unpack()
+            d[key] = self.unpack()
+        return d
+
+def unpack(data):
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(data, strict_map_key=False)
+        except msgpack.ExtraData:
+            raise ValueError("extra data after msgpack value")
+    return unpackPure(data)
+
+def unpackPure(data):
+    unpacker = Unpacker(data)
+    value = unpacker.unpack()
+    if unpacker.pos != len(data):
+        raise ValueError("extra data after msgpack value")
+    return value
+
+def benchmark(count=100000):
+    import json
+    import time
+    from squirrel_fixtures import generateSquirrels
+    squirrels = [{"id": i + 1, "name": name, "size": size} for i, (name, size) in enumerate(generateSquirrels(count))]
+
+    start = time.perf_counter()
+    jsonPayload = bytes(json.dumps(squirrels), "utf-8")
+    jsonSeconds = time.perf_counter() - start
+    batches = [squirrels[i:i + 1024] for i in range(0, count, 1024)]
+    start = time.perf_counter()
+    msgpackPayload = b"".join(packStream(count, batches))
+    msgpackSeconds = time.perf_counter() - start
+
+    print("%d squirrels" % count)
+    print("json.dumps       %8.1fms %10d bytes" % (jsonSeconds * 1000, len(jsonPayload)))
+    print("msgpack (%s) %8.1fms %10d bytes" % ("native" if msgpack is not None else "python", msgpackSeconds * 1000, len(msgpackPayload)))
+    if msgpack is not None:
+        start = time.perf_counter()
+        packer = Packer()
+        size = len(packArrayHeader(count)) + sum(len(packer.packItems(batch)) for batch in batches)
+        print("msgpack (python) %8.1fms %10d bytes" % ((time.perf_counter() - start) * 1000, size))
+    return jsonSeconds, len(jsonPayload), msgpackSeconds, len(msgpackPayload)
+
+if __name__ == '__main__':
+    import sys
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
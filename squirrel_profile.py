@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.sampleCount = 0
+        self.thread = None
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, outPath=None):
+        if self.isRunning():
+            return False
+        self.samples = Counter()
+        self.sampleCount = 0
+        self.thread = threading.Thread(target=self.run, args=(seconds, outPath), daemon=True)
+        self.thread.start()
+        return True
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self, seconds, outPath):
+        ownId = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for threadId, frame in sys._current_frames().items():
+                if threadId != ownId:
+                    self.samples[self.collapseStack(frame)] += 1
+            self.sampleCount += 1
+            time.sleep(self.interval)
+        if outPath:
+            self.save(outPath)
+
+    def collapseStack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    def save(self, outPath):
+        # collapsed stack format, readable by flamegraph.pl and speedscope
+        with open(outPath, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (stack, count))
@@ -1,14 +1,42 @@
-import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import time
+
+# taken before the other imports so startup reports include them
+STARTED_AT = time.perf_counter()
+
+import os
+import signal
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs
 from squirrel_db import SquirrelDB
 
+# argparse, json, squirrel_msgpack and squirrel_profile are imported on first use so that short-lived workers
+# do not pay for them before they can accept a connection
+
+# tunables that can be overridden by a JSON --config file and reloaded with SIGHUP
+DEFAULT_SETTINGS = {
+    # requests slower than this are logged with a per-phase breakdown; 0 disables the log
+    "slowRequestMs": float(os.environ.get("SQUIRREL_SLOW_REQUEST_MS", "0")),
+    "profileSeconds": float(os.environ.get("SQUIRREL_PROFILE_SECONDS", "10")),
+    # passed to PRAGMA cache_size; None keeps SQLite's default
+    "cacheSize": None,
+    "workers": 16,
+    "maxBodyBytes": 64 * 1024,
+    # seconds a client may go quiet mid-request before its worker gives up on it
+    "requestTimeout": 30.0,
+    "drainSeconds": 10.0,
+}
+PHASES = ("parse", "db", "serialize", "write")
+
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HTTP METHODS
 
     def do_GET(self):
-        resourceName, resourceId = self.parsePath()
+        with self.phase("parse"):
+            resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handleSquirrelsRetrieve(resourceId)
@@ -18,7 +46,8 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             self.handle404()
 
     def do_POST(self):
-        resourceName, resourceId = self.parsePath()
+        with self.phase("parse"):
+            resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handle404()
@@ -28,7 +57,8 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             self.handle404()
 
     def do_PUT(self):
-        resourceName, resourceId = self.parsePath()
+        with self.phase("parse"):
+            resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handleSquirrelsUpdate(resourceId)
@@ -38,7 +68,8 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             self.handle404()
 
     def do_DELETE(self):
-        resourceName, resourceId = self.parsePath()
+        with self.phase("parse"):
+            resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handleSquirrelsDelete(resourceId)
@@ -47,14 +78,39 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
+    def setup(self):
+        self.timeout = self.server.settings["requestTimeout"]
+        super().setup()
+
+    def handle_one_request(self):
+        self.settings = self.server.settings
+        self.phaseTimes = {}
+        self.db = None
+        start = time.perf_counter()
+        try:
+            super().handle_one_request()
+            # logged before the connection goes back to the pool, where another request
+            # could reset its sqlTimings
+            if self.settings["slowRequestMs"] > 0 and self.phaseTimes:
+                self.logSlowRequest((time.perf_counter() - start) * 1000)
+        finally:
+            if self.db:
+                self.server.returnDb(self.db)
+
     # HELPERS
 
     def getRequestData(self):
-        length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
-        data = parse_qs(body)
-        for key in data:
-            data[key] = data[key][0]
+        with self.phase("parse"):
+            length = int(self.headers["Content-Length"])
+            tooLarge = length > self.settings["maxBodyBytes"]
+            if not tooLarge:
+                body = self.rfile.read(length).decode("utf-8")
+                data = parse_qs(body)
+                for key in data:
+                    data[key] = data[key][0]
+        if tooLarge:
+            self.handle413()
+            return None
         return data
 
     def parsePath(self):
@@ -67,67 +123,388 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             return (resourceName, resourceId)
         return False
 
+    def prefersMsgpack(self):
+        return prefersMsgpack(self.headers.get("Accept", ""))
+
+    def streamMsgpackList(self):
+        from squirrel_msgpack import newPacker, packArrayHeader
+        with self.phase("db"):
+            count, batches = self.openDb().getSquirrelsInBatches()
+        with self.phase("write"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/msgpack")
+            self.send_header("Vary", "Accept")
+            self.end_headers()
+            self.wfile.write(packArrayHeader(count))
+        packer = newPacker()
+        sent = 0
+        try:
+            while sent < count:
+                with self.phase("db"):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                batch = batch[:count - sent]
+                with self.phase("serialize"):
+                    chunk = packer.packItems(batch)
+                with self.phase("write"):
+                    self.wfile.write(chunk)
+                sent += len(batch)
+        finally:
+            batches.close()
+        if sent < count:
+            # rows were deleted after the header went out; cut the body short rather than
+            # send an array that is shorter than its header says
+            self.log_error("squirrel list changed while streaming: sent %d of %d", sent, count)
+            self.close_connection = True
+
+    def openDb(self):
+        if self.db is None:
+            self.db = self.server.borrowDb(self.settings)
+        return self.db
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phaseTimes[name] = self.phaseTimes.get(name, 0) + time.perf_counter() - start
+
+    def logSlowRequest(self, elapsedMs):
+        if elapsedMs < self.settings["slowRequestMs"]:
+            return
+        phases = " ".join("%s=%.1fms" % (name, self.phaseTimes.get(name, 0) * 1000) for name in PHASES)
+        self.log_message("slow request %s %s %.1fms %s", self.command, self.path, elapsedMs, phases)
+        if self.db:
+            for statement, seconds in self.db.sqlTimings:
+                self.log_message("  sql %.1fms %s", seconds * 1000, statement)
+
     # ACTIONS
 
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
-
-    def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
+        if self.prefersMsgpack():
+            self.streamMsgpackList()
+            return
+        with self.phase("db"):
+            squirrelsList = self.openDb().getSquirrels()
+        with self.phase("serialize"):
+            payload = encodeJson(squirrelsList)
+        with self.phase("write"):
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
+            self.send_header("Vary", "Accept")
             self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+            self.wfile.write(payload)
+
+    def handleSquirrelsRetrieve(self, squirrelId):
+        with self.phase("db"):
+            squirrel = self.openDb().getSquirrel(squirrelId)
+        if squirrel:
+            with self.phase("serialize"):
+                if self.prefersMsgpack():
+                    contentType, payload = "application/msgpack", encodeMsgpack(squirrel)
+                else:
+                    contentType, payload = "application/json", encodeJson(squirrel)
+            with self.phase("write"):
+                self.send_response(200)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Vary", "Accept")
+                self.end_headers()
+                self.wfile.write(payload)
         else:
             self.handle404()
 
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
+        with self.phase("db"):
+            db = self.openDb()
         body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
-        self.end_headers()
+        if body is None:
+            return
+        with self.phase("db"):
+            db.createSquirrel(body["name"], body["size"])
+        with self.phase("write"):
+            self.send_response(201)
+            self.end_headers()
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.phase("db"):
+            db = self.openDb()
+            squirrel = db.getSquirrel(squirrelId)
         if squirrel:
             body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+            if body is None:
+                return
+            with self.phase("db"):
+                db.updateSquirrel(squirrelId, body["name"], body["size"])
+            with self.phase("write"):
+                self.send_response(204)
+                self.end_headers()
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.phase("db"):
+            db = self.openDb()
+            squirrel = db.getSquirrel(squirrelId)
         if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+            with self.phase("db"):
+                db.deleteSquirrel(squirrelId)
+            with self.phase("write"):
+                self.send_response(204)
+                self.end_headers()
         else:
             self.handle404()
 
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        with self.phase("write"):
+            self.send_response(404)
+            self.send_header("Content-Type", "text/plain")
+            self.end_headers()
+            self.wfile.write(bytes("404 Not Found", "utf-8"))
+
+    def handle413(self):
+        with self.phase("write"):
+            self.send_response(413)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(bytes("413 Payload Too Large", "utf-8"))
+        self.close_connection = True
+
+class SquirrelServer(ThreadingHTTPServer):
+
+    # in-flight requests are drained by drain(), not by joining threads in server_close()
+    daemon_threads = True
+
+    def __init__(self, listen, settings, dbPath="squirrel_db.db"):
+        super().__init__(listen, SquirrelServerHandler)
+        self.settings = settings
+        self.dbPath = dbPath
+        self.profiler = None
+        self.startedAt = STARTED_AT
+        self.firstAccepted = False
+        self.activeRequests = 0
+        self.activeChanged = threading.Condition()
+        self.stopping = False
+        # warm connections kept between requests; last in, first out so the hottest is reused
+        self.idleDbs = []
+        self.idleDbsLock = threading.Lock()
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+    def get_request(self):
+        request = super().get_request()
+        if not self.firstAccepted:
+            self.firstAccepted = True
+            sys.stderr.write("first connection accepted %.1fms after start\n" % ((time.perf_counter() - self.startedAt) * 1000))
+        return request
+
+    def process_request(self, request, client_address):
+        # hold off accepting more work while every worker is busy, unless shutting down
+        with self.activeChanged:
+            while self.activeRequests >= self.settings["workers"] and not self.stopping:
+                self.activeChanged.wait()
+            if self.stopping:
+                self.shutdown_request(request)
+                return
+            self.activeRequests += 1
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.activeChanged:
+                self.activeRequests -= 1
+                self.activeChanged.notify_all()
+
+    def reload(self, settings):
+        with self.activeChanged:
+            self.settings = settings
+            self.activeChanged.notify_all()
+
+    def stopAccepting(self):
+        # wakes an accept loop waiting for a free worker, so shutdown() cannot block on it
+        with self.activeChanged:
+            self.stopping = True
+            self.activeChanged.notify_all()
+        self.shutdown()
+
+    def drain(self, seconds):
+        deadline = time.monotonic() + seconds
+        with self.activeChanged:
+            while self.activeRequests > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.activeChanged.wait(remaining)
+        return True
+
+    def borrowDb(self, settings):
+        with self.idleDbsLock:
+            db = self.idleDbs.pop() if self.idleDbs else None
+        if db is None:
+            db = SquirrelDB(dbPath=self.dbPath, shared=True)
+        db.configure(traceSql=settings["slowRequestMs"] > 0, cacheSize=settings["cacheSize"])
+        return db
+
+    def returnDb(self, db):
+        if db.connection.in_transaction:
+            db.connection.rollback()
+        with self.idleDbsLock:
+            if not self.stopping and len(self.idleDbs) < self.settings["workers"]:
+                self.idleDbs.append(db)
+                return
+        db.close()
+
+    def closeDbs(self):
+        with self.idleDbsLock:
+            idleDbs, self.idleDbs = self.idleDbs, []
+        for db in idleDbs:
+            db.close()
+
+    def warm(self):
+        # opens the first pooled connection up front so sqlite3 is loaded, the schema is
+        # parsed before the first request, and a wrong --db path fails at startup
+        if not os.path.isfile(self.dbPath):
+            raise SystemExit("squirrel_server: %s does not exist" % self.dbPath)
+        db = self.borrowDb(self.settings)
+        if not db.hasSquirrelsTable():
+            db.close()
+            raise SystemExit("squirrel_server: %s has no squirrels table" % self.dbPath)
+        self.returnDb(db)
+
+    def checkpoint(self):
+        db = SquirrelDB(dbPath=self.dbPath)
+        db.checkpoint()
+        db.close()
+
+    def startProfile(self):
+        if self.profiler is None:
+            from squirrel_profile import SamplingProfiler
+            self.profiler = SamplingProfiler()
+        seconds = self.settings["profileSeconds"]
+        outPath = "squirrel_profile_%d.txt" % int(time.time())
+        if self.profiler.start(seconds, outPath):
+            print("profiling for %gs, writing %s" % (seconds, outPath), flush=True)
+
+def encodeJson(value):
+    import json
+    return bytes(json.dumps(value), "utf-8")
+
+def encodeMsgpack(value):
+    from squirrel_msgpack import pack
+    return pack(value)
+
+def prefersMsgpack(accept):
+    # JSON stays the default; msgpack is sent only when the client ranks it at least as high
+    msgpackQ = 0.0
+    jsonQ = 0.0
+    for mediaRange in accept.split(","):
+        mediaType, _, params = mediaRange.partition(";")
+        mediaType = mediaType.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if mediaType in ("application/msgpack", "application/x-msgpack"):
+            msgpackQ = max(msgpackQ, q)
+        elif mediaType in ("application/json", "application/*", "*/*"):
+            jsonQ = max(jsonQ, q)
+    return msgpackQ > 0 and msgpackQ >= jsonQ
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def isInteger(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# each setting's check and how it is described when a config value fails it
+SETTING_CHECKS = {
+    "slowRequestMs": (lambda v: isNumber(v) and v >= 0, "a number >= 0"),
+    "profileSeconds": (lambda v: isNumber(v) and v > 0, "a number > 0"),
+    "cacheSize": (lambda v: v is None or isInteger(v), "an integer or null"),
+    "workers": (lambda v: isInteger(v) and v >= 1, "an integer >= 1"),
+    "maxBodyBytes": (lambda v: isNumber(v) and v >= 0, "a number >= 0"),
+    "requestTimeout": (lambda v: isNumber(v) and v > 0, "a number > 0"),
+    "drainSeconds": (lambda v: isNumber(v) and v >= 0, "a number >= 0"),
+}
+
+def loadSettings(configPath=None):
+    settings = dict(DEFAULT_SETTINGS)
+    if configPath:
+        import json
+        with open(configPath) as f:
+            overrides = json.load(f)
+        if not isinstance(overrides, dict):
+            raise ValueError("%s must contain a JSON object" % configPath)
+        unknown = set(overrides) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError("unknown settings in %s: %s" % (configPath, ", ".join(sorted(unknown))))
+        settings.update(overrides)
+    for name, (check, expected) in SETTING_CHECKS.items():
+        if not check(settings[name]):
+            raise ValueError("%s must be %s, got %r" % (name, expected, settings[name]))
+    return settings
+
+def parseArgs(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve the squirrels REST API.")
+    parser.add_argument("--host", default=os.environ.get("SQUIRREL_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SQUIRREL_PORT", "8080")))
+    parser.add_argument("--db", default=os.environ.get("SQUIRREL_DB", "squirrel_db.db"))
+    parser.add_argument("--config", default=os.environ.get("SQUIRREL_CONFIG"), help="JSON file of tunables, re-read on SIGHUP")
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    args = parseArgs(argv)
+    try:
+        settings = loadSettings(args.config)
+    except (OSError, ValueError) as e:
+        raise SystemExit("squirrel_server: %s" % e)
+    server = SquirrelServer((args.host, args.port), settings, args.db)
+    server.warm()
+
+    stopRequested = threading.Event()
+
+    def handleStop(signum, frame):
+        stopRequested.set()
+
+    def handleReload(signum, frame):
+        try:
+            server.reload(loadSettings(args.config))
+            print("reloaded settings from %s" % args.config, flush=True)
+        except (OSError, ValueError) as e:
+            print("keeping previous settings: %s" % e, flush=True)
+
+    signal.signal(signal.SIGTERM, handleStop)
+    signal.signal(signal.SIGINT, handleStop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, handleReload)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.startProfile())
+
+    serveThread = threading.Thread(target=server.serve_forever)
+    serveThread.start()
+    # announced only once signal handlers are in place, so a supervisor can signal right away
+    host, port = server.server_address[:2]
+    print("squirrel_server running at %s:%d" % (host, port), flush=True)
+    sys.stderr.write("ready %.1fms after start\n" % ((time.perf_counter() - STARTED_AT) * 1000))
+    # signal handlers only run on the main thread, so it waits here instead of serving
+    while not stopRequested.wait(0.5):
+        pass
+
+    print("squirrel_server shutting down", flush=True)
+    server.stopAccepting()
+    serveThread.join()
+    server.server_close()
+    if not server.drain(server.settings["drainSeconds"]):
+        print("gave up waiting for %d in-flight requests" % server.activeRequests, flush=True)
+    server.closeDbs()
+    server.checkpoint()
 
 if __name__ == '__main__':
     run()
-
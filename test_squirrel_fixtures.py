@@ -0,0 +1,102 @@
+import os
+import pytest
+import sqlite3
+from squirrel_db import SquirrelDB
+from squirrel_fixtures import generateSquirrels, populate, restore, snapshot, SIZES
+
+
+
+
+@pytest.fixture
+def db_filename():
+    return "fixture_squirrel_db.db"
+
+@pytest.fixture
+def snapshot_filename():
+    return "fixture_squirrel_db.snapshot"
+
+@pytest.fixture(autouse=True)
+def cleanup(db_filename, snapshot_filename):
+    yield
+    for filename in (db_filename, snapshot_filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def read_squirrels(filename):
+    db = SquirrelDB(dbPath=filename)
+    try:
+        return db.getSquirrels()
+    finally:
+        db.close()
+
+
+
+
+def describe_generateSquirrels():
+
+    def it_generates_the_requested_count():
+        assert len(list(generateSquirrels(100))) == 100
+
+    def it_generates_names_and_known_sizes():
+        for name, size in generateSquirrels(100):
+            assert name
+            assert size in SIZES
+
+    def it_is_repeatable_for_a_seed():
+        assert list(generateSquirrels(50, seed=7)) == list(generateSquirrels(50, seed=7))
+
+
+def describe_populate():
+
+    def it_loads_across_several_batches(db_filename):
+        assert populate(db_filename, 1050, batchSize=100) == 1050
+        squirrels = read_squirrels(db_filename)
+        assert len(squirrels) == 1050
+        assert squirrels[-1]["id"] == 1050
+
+    def it_starts_from_an_empty_database(db_filename):
+        populate(db_filename, 10)
+        assert populate(db_filename, 20) == 20
+
+    def it_appends_when_not_fresh(db_filename):
+        populate(db_filename, 10)
+        assert populate(db_filename, 20, fresh=False) == 30
+
+
+def describe_snapshot_and_restore():
+
+    def it_restores_the_snapshotted_rows(db_filename, snapshot_filename):
+        populate(db_filename, 500)
+        snapshot(db_filename, snapshot_filename)
+        populate(db_filename, 5)
+        restore(snapshot_filename, db_filename)
+        assert len(read_squirrels(db_filename)) == 500
+
+    def it_restores_identical_data(db_filename, snapshot_filename):
+        populate(db_filename, 200, seed=3)
+        original = read_squirrels(db_filename)
+        snapshot(db_filename, snapshot_filename)
+        os.remove(db_filename)
+        restore(snapshot_filename, db_filename)
+        assert read_squirrels(db_filename) == original
+
+    def it_refuses_to_restore_a_missing_snapshot(db_filename, snapshot_filename):
+        populate(db_filename, 50)
+        with pytest.raises(FileNotFoundError):
+            restore(snapshot_filename, db_filename)
+        assert not os.path.exists(snapshot_filename)
+        assert len(read_squirrels(db_filename)) == 50
+
+    def it_refuses_to_snapshot_a_missing_database(db_filename, snapshot_filename):
+        with pytest.raises(FileNotFoundError):
+            snapshot(db_filename, snapshot_filename)
+        assert not os.path.exists(db_filename)
+        assert not os.path.exists(snapshot_filename)
+
+    def it_refuses_to_copy_a_file_without_squirrels(db_filename, snapshot_filename):
+        populate(db_filename, 50)
+        sqlite3.connect(snapshot_filename).close()
+        with pytest.raises(ValueError):
+            restore(snapshot_filename, db_filename)
+        assert len(read_squirrels(db_filename)) == 50
@@ -0,0 +1,112 @@
+import pytest
+import squirrel_msgpack
+from squirrel_msgpack import Packer, benchmark, pack, packStream, unpack, unpackPure
+
+
+
+
+def pack_pure(value):
+    packer = Packer()
+    packer.packValue(value)
+    return packer.take()
+
+@pytest.fixture
+def squirrels():
+    return [{"id": i, "name": "Squirrel %d" % i, "size": "small"} for i in range(1, 2001)]
+
+@pytest.fixture
+def batches(squirrels):
+    return [squirrels[i:i + 500] for i in range(0, len(squirrels), 500)]
+
+@pytest.fixture
+def pure_python(monkeypatch):
+    monkeypatch.setattr(squirrel_msgpack, "msgpack", None)
+
+@pytest.fixture
+def value():
+    return {
+        "ints": [0, 127, 128, -32, -33, 70000, 2 ** 40, -2 ** 40],
+        "strings": ["", "é" * 40, "x" * 300, "y" * 70000],
+        "other": [None, True, False, 1.5, b"raw", b"r" * 300, b"s" * 70000],
+        1: {"nested": {}},
+    }
+
+
+
+
+def describe_Packer():
+
+    def it_matches_the_msgpack_spec_for_small_values():
+        assert pack_pure(None) == b"\xc0"
+        assert pack_pure(True) == b"\xc3"
+        assert pack_pure(5) == b"\x05"
+        assert pack_pure(-1) == b"\xff"
+        assert pack_pure("id") == b"\xa2id"
+        assert pack_pure({"id": 1}) == b"\x81\xa2id\x01"
+        assert pack_pure([1, 2]) == b"\x92\x01\x02"
+
+    def it_uses_wider_encodings_for_large_values():
+        assert pack_pure(300) == b"\xcd\x01\x2c"
+        assert pack_pure(-200) == b"\xd1\xff\x38"
+        assert pack_pure("x" * 40)[:2] == b"\xd9\x28"
+        assert pack_pure(list(range(20)))[:3] == b"\xdc\x00\x14"
+
+    def it_round_trips_every_supported_type(value):
+        assert unpackPure(pack_pure(value)) == value
+
+    def it_rejects_unsupported_types():
+        with pytest.raises(TypeError):
+            pack_pure(object())
+
+    def it_matches_the_msgpack_library(value):
+        msgpack = pytest.importorskip("msgpack")
+        assert pack_pure(value) == msgpack.packb(value)
+        assert unpackPure(msgpack.packb(value)) == value
+
+
+def describe_pack():
+
+    def it_round_trips_every_supported_type(value):
+        assert unpack(pack(value)) == value
+
+    def it_round_trips_without_the_msgpack_library(pure_python, value):
+        assert unpack(pack(value)) == value
+
+
+def describe_packStream():
+
+    def it_produces_the_same_bytes_as_pack(squirrels, batches):
+        assert b"".join(packStream(len(squirrels), batches)) == pack(squirrels)
+
+    def it_produces_the_same_bytes_without_the_msgpack_library(pure_python, squirrels, batches):
+        assert b"".join(packStream(len(squirrels), batches)) == pack(squirrels)
+
+    def it_yields_the_header_then_one_chunk_per_batch(squirrels, batches):
+        assert len(list(packStream(len(squirrels), batches))) == 5
+
+    def it_handles_an_empty_list():
+        assert b"".join(packStream(0, [])) == b"\x90"
+
+
+def describe_unpack():
+
+    def it_rejects_truncated_data():
+        with pytest.raises(ValueError):
+            unpack(pack("squirrel")[:-1])
+
+    def it_rejects_trailing_data():
+        with pytest.raises(ValueError):
+            unpack(pack(1) + b"\x01")
+
+    def it_rejects_bad_data_without_the_msgpack_library(pure_python):
+        with pytest.raises(ValueError):
+            unpack(pack_pure("squirrel")[:-1])
+        with pytest.raises(ValueError):
+            unpack(pack_pure(1) + b"\x01")
+
+
+def describe_benchmark():
+
+    def it_sends_smaller_payloads_than_json():
+        jsonSeconds, jsonBytes, msgpackSeconds, msgpackBytes = benchmark(5000)
+        assert msgpackBytes < jsonBytes * 0.75
@@ -0,0 +1,58 @@
+import os
+import threading
+import pytest
+from squirrel_profile import SamplingProfiler
+
+
+
+
+@pytest.fixture
+def profile_filename():
+    filename = "test_profile.txt"
+    yield filename
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+
+
+def describe_SamplingProfiler():
+
+    def it_samples_other_threads():
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_worker, args=(stop,))
+        worker.start()
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start(0.2)
+        profiler.join()
+        stop.set()
+        worker.join()
+        assert profiler.sampleCount > 0
+        assert any("busy_worker" in stack for stack in profiler.samples)
+
+    def it_does_not_sample_itself():
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start(0.05)
+        profiler.join()
+        assert not any("collapseStack" in stack for stack in profiler.samples)
+
+    def it_refuses_to_start_twice():
+        profiler = SamplingProfiler()
+        assert profiler.start(0.2)
+        assert not profiler.start(0.2)
+        profiler.join()
+
+    def it_writes_collapsed_stacks(profile_filename):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start(0.05, profile_filename)
+        profiler.join()
+        with open(profile_filename) as f:
+            lines = f.read().splitlines()
+        assert len(lines) > 0
+        stack, count = lines[0].rsplit(" ", 1)
+        assert "(" in stack
+        assert int(count) > 0
@@ -3,6 +3,8 @@ import json
 import os
 import pytest
 import shutil
+import signal
+import socket
 import subprocess
 import sys
 import time
@@ -474,3 +476,411 @@ def describe_404_cases():
         http_client.request("DELETE", "/birds/1")
         response = http_client.getresponse()
         assert response.status == 404
+
+
+def describe_sql_tracing():
+
+    def it_records_nothing_when_tracing_is_off(clean_db, db):
+        db.getSquirrels()
+        assert db.sqlTimings == []
+
+    def it_records_each_statement_with_bound_values(clean_db):
+        db = SquirrelDB(traceSql=True)
+        db.createSquirrel("Chip", "small")
+        db.getSquirrel(1)
+        statements = [statement for statement, seconds in db.sqlTimings]
+        assert statements == [
+            "BEGIN; INSERT INTO squirrels (name, size) VALUES ('Chip', 'small')",
+            "COMMIT",
+            "SELECT * FROM squirrels WHERE id = 1",
+        ]
+
+    def it_summarises_batched_inserts(clean_db):
+        db = SquirrelDB(traceSql=True)
+        db.createSquirrels([("Chip", "small")] * 5)
+        assert db.sqlTimings[0][0].endswith("; ... (6 statements)")
+        assert db.sqlTimings[1][0] == "COMMIT"
+
+    def it_times_each_batch_query(clean_db):
+        db = SquirrelDB(traceSql=True)
+        db.createSquirrels([("Chip", "small")] * 5)
+        db.configure(traceSql=True)
+        count, batches = db.getSquirrelsInBatches(batchSize=2)
+        list(batches)
+        statements = [statement for statement, seconds in db.sqlTimings]
+        assert statements[0].startswith("SELECT COUNT(*)")
+        assert len(statements) == 5
+        assert all(s.startswith("SELECT * FROM squirrels WHERE id >") for s in statements[1:])
+
+    def it_records_non_negative_durations(clean_db):
+        db = SquirrelDB(traceSql=True)
+        db.getSquirrels()
+        assert len(db.sqlTimings) == 1
+        assert db.sqlTimings[0][1] >= 0
+
+    def it_reads_squirrels_in_batches(clean_db):
+        db = SquirrelDB()
+        db.createSquirrels([("Squirrel %d" % i, "small") for i in range(25)])
+        count, batches = db.getSquirrelsInBatches(batchSize=10)
+        sizes = [len(batch) for batch in batches]
+        assert count == 25
+        assert sizes == [10, 10, 5]
+        assert not db.connection.in_transaction
+
+    def it_leaves_out_rows_added_after_the_count(clean_db):
+        db = SquirrelDB()
+        db.createSquirrels([("Squirrel %d" % i, "small") for i in range(5)])
+        count, batches = db.getSquirrelsInBatches(batchSize=2)
+        first = next(batches)
+        db.createSquirrel("Late", "large")
+        rows = first + [row for batch in batches for row in batch]
+        assert count == 5
+        assert [row["id"] for row in rows] == [1, 2, 3, 4, 5]
+
+    def it_reads_no_batches_from_an_empty_table(clean_db):
+        count, batches = SquirrelDB().getSquirrelsInBatches()
+        assert count == 0
+        assert list(batches) == []
+
+    def it_resets_tracing_when_reconfigured(clean_db):
+        db = SquirrelDB(traceSql=True)
+        db.getSquirrels()
+        db.configure(traceSql=False)
+        db.getSquirrels()
+        assert db.sqlTimings == []
+
+
+@pytest.fixture
+def pooled_server(clean_db):
+    from squirrel_server import SquirrelServer, loadSettings
+    server = SquirrelServer(("127.0.0.1", 0), loadSettings())
+    yield server
+    server.closeDbs()
+    server.server_close()
+
+
+def describe_connection_pool():
+
+    def it_warms_a_connection_that_requests_reuse(pooled_server):
+        pooled_server.warm()
+        warmed = pooled_server.idleDbs[0]
+        assert pooled_server.borrowDb(pooled_server.settings) is warmed
+
+    def it_returns_connections_for_reuse(pooled_server):
+        db = pooled_server.borrowDb(pooled_server.settings)
+        pooled_server.returnDb(db)
+        assert pooled_server.borrowDb(pooled_server.settings) is db
+
+    def it_applies_the_current_settings_on_borrow(pooled_server):
+        db = pooled_server.borrowDb(pooled_server.settings)
+        pooled_server.returnDb(db)
+        settings = dict(pooled_server.settings, slowRequestMs=1, cacheSize=-4096)
+        db = pooled_server.borrowDb(settings)
+        db.getSquirrels()
+        assert len(db.sqlTimings) == 1
+        db.cursor.execute("PRAGMA cache_size")
+        assert db.cursor.fetchone()["cache_size"] == -4096
+
+    def it_closes_connections_returned_while_stopping(pooled_server):
+        db = pooled_server.borrowDb(pooled_server.settings)
+        pooled_server.stopping = True
+        pooled_server.returnDb(db)
+        assert pooled_server.idleDbs == []
+
+
+posix_only = pytest.mark.skipif(sys.platform == "win32", reason="needs SIGHUP")
+
+
+@pytest.fixture
+def lifecycle_files():
+    db_path = "lifecycle_squirrel_db.db"
+    config_path = "lifecycle_config.json"
+    shutil.copyfile("empty_squirrel_db.db", db_path)
+    with open(config_path, "w") as f:
+        json.dump({"maxBodyBytes": 1024}, f)
+    yield db_path, config_path
+    for path in (db_path, config_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@pytest.fixture
+def lifecycle_server(lifecycle_files):
+    db_path, config_path = lifecycle_files
+    proc = subprocess.Popen([sys.executable, "squirrel_server.py", "--port", "0", "--db", db_path, "--config", config_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = proc.stdout.readline()
+    port = int(line.rsplit(":", 1)[1])
+    yield proc, port
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    proc.stdout.close()
+
+
+@posix_only
+def describe_server_lifecycle():
+
+    def it_listens_on_the_configured_port_and_db(lifecycle_server, lifecycle_files, request_headers, request_body):
+        proc, port = lifecycle_server
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("POST", "/squirrels", body=request_body, headers=request_headers)
+        assert conn.getresponse().status == 201
+        conn.close()
+        squirrels = SquirrelDB(dbPath=lifecycle_files[0]).getSquirrels()
+        assert [s["name"] for s in squirrels] == ["Sam"]
+
+    def it_rejects_bodies_over_the_limit(lifecycle_server, request_headers):
+        proc, port = lifecycle_server
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("POST", "/squirrels", body="name=" + "a" * 2000 + "&size=large", headers=request_headers)
+        assert conn.getresponse().status == 413
+        conn.close()
+
+    def it_reloads_limits_on_sighup(lifecycle_server, lifecycle_files, request_headers):
+        proc, port = lifecycle_server
+        with open(lifecycle_files[1], "w") as f:
+            json.dump({"maxBodyBytes": 4096}, f)
+        os.kill(proc.pid, signal.SIGHUP)
+        assert proc.stdout.readline().startswith("reloaded settings")
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("POST", "/squirrels", body="name=" + "a" * 2000 + "&size=large", headers=request_headers)
+        assert conn.getresponse().status == 201
+        conn.close()
+
+    def it_keeps_settings_when_reload_fails(lifecycle_server, lifecycle_files, request_headers):
+        proc, port = lifecycle_server
+        with open(lifecycle_files[1], "w") as f:
+            json.dump({"noSuchSetting": 1}, f)
+        os.kill(proc.pid, signal.SIGHUP)
+        assert proc.stdout.readline().startswith("keeping previous settings")
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("POST", "/squirrels", body="name=" + "a" * 2000 + "&size=large", headers=request_headers)
+        assert conn.getresponse().status == 413
+        conn.close()
+
+    def it_keeps_settings_when_a_reloaded_value_has_the_wrong_type(lifecycle_server, lifecycle_files, request_headers):
+        proc, port = lifecycle_server
+        for bad in ({"workers": "4"}, {"cacheSize": "big"}, {"maxBodyBytes": None}):
+            with open(lifecycle_files[1], "w") as f:
+                json.dump(bad, f)
+            os.kill(proc.pid, signal.SIGHUP)
+            assert proc.stdout.readline().startswith("keeping previous settings")
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("POST", "/squirrels", body="name=Sam&size=large", headers=request_headers)
+        assert conn.getresponse().status == 201
+        conn.close()
+        os.kill(proc.pid, signal.SIGTERM)
+        assert proc.wait(timeout=5) == 0
+
+    def it_refuses_to_start_with_an_invalid_config(lifecycle_files):
+        db_path, config_path = lifecycle_files
+        with open(config_path, "w") as f:
+            json.dump({"cacheSize": "big"}, f)
+        result = subprocess.run([sys.executable, "squirrel_server.py", "--port", "0", "--db", db_path, "--config", config_path],
+                                capture_output=True, text=True, timeout=10)
+        assert result.returncode == 1
+        assert result.stderr.strip() == "squirrel_server: cacheSize must be an integer or null, got 'big'"
+
+    def it_finishes_in_flight_requests_on_sigterm(lifecycle_server, lifecycle_files):
+        proc, port = lifecycle_server
+        body = b"name=Drained&size=small"
+        sock = socket.create_connection(("localhost", port))
+        sock.sendall(b"POST /squirrels HTTP/1.0\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                     b"Content-Length: %d\r\n\r\n" % len(body) + body[:5])
+        time.sleep(0.2)
+        os.kill(proc.pid, signal.SIGTERM)
+        assert proc.stdout.readline().startswith("squirrel_server shutting down")
+        sock.sendall(body[5:])
+        response = sock.recv(1024)
+        sock.close()
+        assert response.startswith(b"HTTP/1.0 201")
+        assert proc.wait(timeout=5) == 0
+        squirrels = SquirrelDB(dbPath=lifecycle_files[0]).getSquirrels()
+        assert [s["name"] for s in squirrels] == ["Drained"]
+
+    def it_shuts_down_within_the_drain_deadline_when_saturated(lifecycle_files):
+        db_path, config_path = lifecycle_files
+        with open(config_path, "w") as f:
+            json.dump({"workers": 1, "drainSeconds": 1}, f)
+        proc = subprocess.Popen([sys.executable, "squirrel_server.py", "--port", "0", "--db", db_path, "--config", config_path],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            port = int(proc.stdout.readline().rsplit(":", 1)[1])
+            stalled = socket.create_connection(("localhost", port))
+            stalled.sendall(b"GET /squir")
+            waiting = socket.create_connection(("localhost", port))
+            time.sleep(0.2)
+            start = time.monotonic()
+            os.kill(proc.pid, signal.SIGTERM)
+            assert proc.wait(timeout=5) == 0
+            assert time.monotonic() - start < 3
+            stalled.close()
+            waiting.close()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+    def it_times_out_stalled_clients(lifecycle_files):
+        db_path, config_path = lifecycle_files
+        with open(config_path, "w") as f:
+            json.dump({"workers": 1, "requestTimeout": 0.2}, f)
+        proc = subprocess.Popen([sys.executable, "squirrel_server.py", "--port", "0", "--db", db_path, "--config", config_path],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            port = int(proc.stdout.readline().rsplit(":", 1)[1])
+            stalled = socket.create_connection(("localhost", port))
+            stalled.sendall(b"GET /squir")
+            conn = http.client.HTTPConnection("localhost", port, timeout=5)
+            conn.request("GET", "/squirrels")
+            assert conn.getresponse().status == 200
+            conn.close()
+            stalled.close()
+        finally:
+            proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+    def it_stops_accepting_after_sigterm(lifecycle_server):
+        proc, port = lifecycle_server
+        os.kill(proc.pid, signal.SIGTERM)
+        assert proc.wait(timeout=5) == 0
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection(("localhost", port))
+
+
+# startup is budgeted against http.server, which the server cannot avoid importing;
+# everything squirrel_server adds on top of it has to fit in these margins
+IMPORT_MARGIN_MS = 30
+FIRST_RESPONSE_MARGIN_MS = 60
+RUNS = 3
+
+
+def import_times_ms(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[1].isdigit():
+            times[fields[2]] = int(fields[1]) / 1000
+    return times
+
+
+def import_overhead_ms():
+    times = import_times_ms("squirrel_server")
+    return times["squirrel_server"] - times["http.server"]
+
+
+def http_server_process_ms():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import http.server"], check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def first_response_ms(db_path):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "squirrel_server.py", "--port", "0", "--db", db_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        port = int(proc.stdout.readline().rsplit(":", 1)[1])
+        conn = http.client.HTTPConnection("localhost", port)
+        conn.request("GET", "/squirrels")
+        assert conn.getresponse().status == 200
+        conn.close()
+        return (time.perf_counter() - start) * 1000
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+
+def describe_startup():
+
+    def it_defers_modules_not_needed_to_accept_connections():
+        deferred = ('argparse', 'json', 'squirrel_msgpack', 'squirrel_profile')
+        result = subprocess.run([sys.executable, "-c",
+                                 "import sys, squirrel_server; print(sorted(m for m in %r if m in sys.modules))" % (deferred,)],
+                                capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == "[]"
+
+    def it_adds_little_import_time_over_http_server():
+        assert min(import_overhead_ms() for _ in range(RUNS)) < IMPORT_MARGIN_MS
+
+    def it_answers_the_first_request_soon_after_http_server_loads(lifecycle_files):
+        baseline = min(http_server_process_ms() for _ in range(RUNS))
+        assert min(first_response_ms(lifecycle_files[0]) for _ in range(RUNS)) < baseline + FIRST_RESPONSE_MARGIN_MS
+
+    def it_refuses_to_start_on_a_missing_database():
+        result = subprocess.run([sys.executable, "squirrel_server.py", "--port", "0", "--db", "no_such_squirrel_db.db"],
+                                capture_output=True, text=True, timeout=10)
+        assert result.returncode == 1
+        assert "does not exist" in result.stderr
+        assert not os.path.exists("no_such_squirrel_db.db")
+
+
+def describe_msgpack_responses():
+
+    def it_lists_squirrels_as_msgpack_when_asked(http_client, clean_db, make_a_squirrel):
+        from squirrel_msgpack import unpack
+        http_client.request("GET", "/squirrels", headers={"Accept": "application/msgpack"})
+        response = http_client.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-Type") == "application/msgpack"
+        assert unpack(response.read()) == [{"id": make_a_squirrel, "name": "Furina", "size": "small"}]
+
+    def it_retrieves_a_squirrel_as_msgpack(http_client, clean_db, make_a_squirrel):
+        from squirrel_msgpack import unpack
+        http_client.request("GET", "/squirrels/%d" % make_a_squirrel, headers={"Accept": "application/x-msgpack"})
+        response = http_client.getresponse()
+        assert response.getheader("Content-Type") == "application/msgpack"
+        assert unpack(response.read()) == {"id": make_a_squirrel, "name": "Furina", "size": "small"}
+
+    def it_streams_large_lists(http_client, clean_db):
+        from squirrel_msgpack import unpack
+        SquirrelDB().createSquirrels([("Squirrel %d" % i, "large") for i in range(5000)])
+        http_client.request("GET", "/squirrels", headers={"Accept": "application/msgpack"})
+        data = unpack(http_client.getresponse().read())
+        assert len(data) == 5000
+        assert data[-1] == {"id": 5000, "name": "Squirrel 4999", "size": "large"}
+
+    def it_streams_an_empty_list(http_client, clean_db):
+        from squirrel_msgpack import unpack
+        http_client.request("GET", "/squirrels", headers={"Accept": "application/msgpack"})
+        assert unpack(http_client.getresponse().read()) == []
+
+    def it_does_not_block_writers_while_a_reader_stalls(clean_db, request_headers, request_body):
+        db = SquirrelDB()
+        db.createSquirrels([("Squirrel %d" % i, "large") for i in range(300000)])
+        db.close()
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stalled.connect(("localhost", 8080))
+        stalled.sendall(b"GET /squirrels HTTP/1.0\r\nAccept: application/msgpack\r\n\r\n")
+        time.sleep(0.5)
+        try:
+            conn = http.client.HTTPConnection("localhost", 8080, timeout=10)
+            start = time.monotonic()
+            conn.request("POST", "/squirrels", body=request_body, headers=request_headers)
+            assert conn.getresponse().status == 201
+            assert time.monotonic() - start < 2
+            conn.close()
+        finally:
+            stalled.close()
+
+    def it_defaults_to_json(http_client):
+        http_client.request("GET", "/squirrels", headers={"Accept": "*/*"})
+        response = http_client.getresponse()
+        assert response.getheader("Content-Type") == "application/json"
+
+    def it_honours_quality_values(http_client):
+        http_client.request("GET", "/squirrels", headers={"Accept": "application/msgpack;q=0.5, application/json"})
+        response = http_client.getresponse()
+        assert response.getheader("Content-Type") == "application/json"
+
+    def it_varies_on_accept(http_client):
+        http_client.request("GET", "/squirrels")
+        response = http_client.getresponse()
+        assert response.getheader("Vary") == "Accept"